@@ -14,12 +14,14 @@
 #
 
 import eventlet
+from eventlet import semaphore
 from oslo_config import cfg
 from oslo_log import log as logging
 import oslo_messaging
 from oslo_utils import excutils
 from oslo_utils import importutils
 from oslo_utils import timeutils
+import six
 
 from neutron.agent.l3 import dvr
 from neutron.agent.l3 import dvr_router
@@ -59,6 +61,58 @@ LOG = logging.getLogger(__name__)
 NS_PREFIX = namespaces.NS_PREFIX
 INTERNAL_DEV_PREFIX = namespaces.INTERNAL_DEV_PREFIX
 EXTERNAL_DEV_PREFIX = namespaces.EXTERNAL_DEV_PREFIX
+SNAT_ROUTER_INTF_KEY = l3_constants.SNAT_ROUTER_INTF_KEY
+# Seconds during which a forced external network id check reuses the result
+# of the previous one
+EXTERNAL_NETWORK_ID_TTL = 30
+# While state reports keep failing, only one failure in this many is logged
+# with its traceback
+REPORT_STATE_TRACEBACK_EVERY = 100
+# Messages logged on every notification or heartbeat, translated only once
+_MSG_AGENT_UPDATED = _LI("agent_updated by server side %s!")
+_MSG_REPORT_STATE_FAILED = _LE("Failed reporting state!")
+_MSG_REPORT_STATE_FAILED_AGAIN = _LW("Failed reporting state! (%d failures "
+                                     "in a row)")
+PORTFORWARDING_CHAIN = 'PREROUTING'
+PORTFORWARDING_TAG = 'portforwarding'
+
+OPTS = [
+    cfg.IntOpt('router_update_coalesce_max', default=32,
+               help=_("Maximum number of queued router updates whose router "
+                      "data is fetched from the server with a single RPC "
+                      "call.")),
+    cfg.IntOpt('router_processing_pool_size', default=64,
+               help=_("Number of green threads processing router updates "
+                      "concurrently.")),
+]
+cfg.CONF.register_opts(OPTS)
+
+
+def _portforwarding_rule(portfwd):
+    """Render the DNAT rule of a portforwarding.
+
+    Equivalent to formatting "-p %(protocol)s -d %(outside_addr)s --dport
+    %(outside_port)s -j DNAT --to %(inside_addr)s:%(inside_port)s" but
+    joins the fields directly, skipping the format parser.
+    """
+    return "".join(("-p ", str(portfwd['protocol']),
+                    " -d ", str(portfwd['outside_addr']),
+                    " --dport ", str(portfwd['outside_port']),
+                    " -j DNAT --to ", str(portfwd['inside_addr']),
+                    ":", str(portfwd['inside_port'])))
+
+
+def _diff_portforwardings(old_portfwds, new_portfwds):
+    """Return the port forwardings added and removed between two lists.
+
+    Each portforwarding dict is keyed by its frozen items so the diff costs
+    a couple of set lookups per rule, and the original dicts are returned.
+    """
+    old_keys = dict((tuple(sorted(p.items())), p) for p in old_portfwds)
+    new_keys = dict((tuple(sorted(p.items())), p) for p in new_portfwds)
+    adds = [p for key, p in six.iteritems(new_keys) if key not in old_keys]
+    removes = [p for key, p in six.iteritems(old_keys) if key not in new_keys]
+    return adds, removes
 
 
 class L3PluginApi(object):
@@ -75,6 +129,7 @@ class L3PluginApi(object):
         1.4 - Added L3 HA update_router_state. This method was reworked in
               to update_ha_routers_states
         1.5 - Added update_ha_routers_states
+        1.6 - Added update_floatingip_statuses_batch
 
     """
 
@@ -82,12 +137,18 @@ class L3PluginApi(object):
         self.host = host
         target = oslo_messaging.Target(topic=topic, version='1.0')
         self.client = n_rpc.get_client(target)
+        # Prepared call contexts are reusable, build them once per version
+        self._cctxt_v10 = self.client.prepare()
+        self._cctxt_v11 = self.client.prepare(version='1.1')
+        self._cctxt_v12 = self.client.prepare(version='1.2')
+        self._cctxt_v13 = self.client.prepare(version='1.3')
+        self._cctxt_v15 = self.client.prepare(version='1.5')
+        self._cctxt_v16 = self.client.prepare(version='1.6')
 
     def get_routers(self, context, router_ids=None):
         """Make a remote process call to retrieve the sync data for routers."""
-        cctxt = self.client.prepare()
-        return cctxt.call(context, 'sync_routers', host=self.host,
-                          router_ids=router_ids)
+        return self._cctxt_v10.call(context, 'sync_routers', host=self.host,
+                                    router_ids=router_ids)
 
     def get_external_network_id(self, context):
         """Make a remote process call to retrieve the external network id.
@@ -96,37 +157,44 @@ class L3PluginApi(object):
                                            exc_type if there are more than one
                                            external network
         """
-        cctxt = self.client.prepare()
-        return cctxt.call(context, 'get_external_network_id', host=self.host)
+        return self._cctxt_v10.call(context, 'get_external_network_id',
+                                    host=self.host)
 
     def update_floatingip_statuses(self, context, router_id, fip_statuses):
         """Call the plugin update floating IPs's operational status."""
-        cctxt = self.client.prepare(version='1.1')
-        return cctxt.call(context, 'update_floatingip_statuses',
-                          router_id=router_id, fip_statuses=fip_statuses)
+        return self._cctxt_v11.call(context, 'update_floatingip_statuses',
+                                    router_id=router_id,
+                                    fip_statuses=fip_statuses)
+
+    def update_floatingip_statuses_batch(self, context, statuses_by_router):
+        """Call the plugin update floating IPs's operational status.
+
+        The statuses of several routers are sent in a single call, keyed by
+        router id.
+        """
+        return self._cctxt_v16.call(context,
+                                    'update_floatingip_statuses_batch',
+                                    host=self.host,
+                                    statuses_by_router=statuses_by_router)
 
     def get_ports_by_subnet(self, context, subnet_id):
         """Retrieve ports by subnet id."""
-        cctxt = self.client.prepare(version='1.2')
-        return cctxt.call(context, 'get_ports_by_subnet', host=self.host,
-                          subnet_id=subnet_id)
+        return self._cctxt_v12.call(context, 'get_ports_by_subnet',
+                                    host=self.host, subnet_id=subnet_id)
 
     def get_agent_gateway_port(self, context, fip_net):
         """Get or create an agent_gateway_port."""
-        cctxt = self.client.prepare(version='1.2')
-        return cctxt.call(context, 'get_agent_gateway_port',
-                          network_id=fip_net, host=self.host)
+        return self._cctxt_v12.call(context, 'get_agent_gateway_port',
+                                    network_id=fip_net, host=self.host)
 
     def get_service_plugin_list(self, context):
         """Make a call to get the list of activated services."""
-        cctxt = self.client.prepare(version='1.3')
-        return cctxt.call(context, 'get_service_plugin_list')
+        return self._cctxt_v13.call(context, 'get_service_plugin_list')
 
     def update_ha_routers_states(self, context, states):
         """Update HA routers states."""
-        cctxt = self.client.prepare(version='1.5')
-        return cctxt.call(context, 'update_ha_routers_states',
-                          host=self.host, states=states)
+        return self._cctxt_v15.call(context, 'update_ha_routers_states',
+                                    host=self.host, states=states)
 
 
 class L3NATAgent(firewall_l3_agent.FWaaSL3AgentRpcCallback,
@@ -155,6 +223,8 @@ class L3NATAgent(firewall_l3_agent.FWaaSL3AgentRpcCallback,
         else:
             self.conf = cfg.CONF
         self.router_info = {}
+        # Set whenever a router changes so the state report counts again
+        self._router_counts_dirty = True
 
         self._check_config_params()
 
@@ -175,6 +245,11 @@ class L3NATAgent(firewall_l3_agent.FWaaSL3AgentRpcCallback,
         self.context = n_context.get_admin_context_without_session()
         self.plugin_rpc = L3PluginApi(topics.L3PLUGIN, host)
         self.fullsync = True
+        # Floating IP statuses waiting to be sent, keyed by router id
+        self._pending_fip_statuses = {}
+        self._fip_statuses_batch_supported = True
+        # Held while floating ip statuses are being sent
+        self._fip_statuses_sending = semaphore.Semaphore()
 
         # Get the list of service plugins from Neutron Server
         # This is the first place where we contact neutron-server on startup
@@ -217,6 +292,9 @@ class L3NATAgent(firewall_l3_agent.FWaaSL3AgentRpcCallback,
         super(L3NATAgent, self).__init__(conf=self.conf)
 
         self.target_ex_net_id = None
+        self._ex_net_id_fetched_at = None
+        # Routers rejected on an external network id reused from the cache
+        self._routers_to_recheck = set()
         self.use_ipv6 = ipv6_utils.is_enabled()
 
         if self.conf.enable_metadata_proxy:
@@ -253,9 +331,20 @@ class L3NATAgent(firewall_l3_agent.FWaaSL3AgentRpcCallback,
         if not force and self.target_ex_net_id:
             return self.target_ex_net_id
 
+        # Several incompatible routers in a row would each force a check, a
+        # recent enough answer is as good as a new one.
+        if (self.target_ex_net_id and
+            not timeutils.is_older_than(self._ex_net_id_fetched_at,
+                                        EXTERNAL_NETWORK_ID_TTL)):
+            LOG.debug("Reusing external network id %s fetched less than "
+                      "%d seconds ago", self.target_ex_net_id,
+                      EXTERNAL_NETWORK_ID_TTL)
+            return self.target_ex_net_id
+
         try:
             self.target_ex_net_id = self.plugin_rpc.get_external_network_id(
                 self.context)
+            self._ex_net_id_fetched_at = timeutils.utcnow()
             return self.target_ex_net_id
         except oslo_messaging.RemoteError as e:
             with excutils.save_and_reraise_exception() as ctx:
@@ -302,6 +391,7 @@ class L3NATAgent(firewall_l3_agent.FWaaSL3AgentRpcCallback,
             adv_svc.AdvancedService.before_router_added, ri)
 
         self.router_info[router_id] = ri
+        self._router_counts_dirty = True
         ri.create()
         self.process_router_add(ri)
 
@@ -324,8 +414,9 @@ class L3NATAgent(firewall_l3_agent.FWaaSL3AgentRpcCallback,
         ri.router['gw_port'] = None
         ri.router[l3_constants.INTERFACE_KEY] = []
         ri.router[l3_constants.FLOATINGIP_KEY] = []
-        self.process_router(ri)
+        self._process_router_teardown(ri)
         del self.router_info[router_id]
+        self._router_counts_dirty = True
         ri.delete()
         self.event_observers.notify(
             adv_svc.AdvancedService.after_router_removed, ri)
@@ -335,18 +426,92 @@ class L3NATAgent(firewall_l3_agent.FWaaSL3AgentRpcCallback,
         ri.floating_ips = set(fip_statuses.keys())
         for fip_id in existing_floating_ips - ri.floating_ips:
             fip_statuses[fip_id] = l3_constants.FLOATINGIP_STATUS_DOWN
-        LOG.debug('Sending floating ip statuses: %s', fip_statuses)
-        # Update floating IP status on the neutron server
-        self.plugin_rpc.update_floatingip_statuses(
-            self.context, ri.router_id, fip_statuses)
+        # Several passes over the router may run before the next batch is
+        # sent, merge into what is still queued so that a DOWN set by an
+        # earlier pass is not lost.
+        pending = dict(self._pending_fip_statuses.get(ri.router_id, {}))
+        pending.update(fip_statuses)
+        statuses = frozenset(six.iteritems(pending))
+        if statuses == ri.sent_fip_statuses:
+            LOG.debug('Floating ip statuses of router %s are unchanged',
+                      ri.router_id)
+            return
+        # Update floating IP status on the neutron server with the next
+        # batch, see _send_fip_statuses.  The snapshot is taken right away
+        # so statuses computed while the batch is in flight are compared
+        # with these and not with older ones.
+        ri.sent_fip_statuses = statuses
+        self._pending_fip_statuses[ri.router_id] = pending
+
+    def _send_fip_statuses(self):
+        """Send the floating ip statuses queued by update_fip_statuses.
+
+        Only one batch is in flight at a time, so the server cannot apply
+        an older batch of a router after a newer one.  Statuses queued
+        while a batch is sent are left to the worker sending it, which
+        sends them next.
+        """
+        if not self._fip_statuses_sending.acquire(blocking=False):
+            return
+        try:
+            while self._pending_fip_statuses:
+                statuses_by_router = self._pending_fip_statuses
+                self._pending_fip_statuses = {}
+                if not self._send_fip_statuses_batch(statuses_by_router):
+                    break
+        finally:
+            self._fip_statuses_sending.release()
+
+    def _send_fip_statuses_batch(self, statuses_by_router):
+        unsent = dict(statuses_by_router)
+        LOG.debug('Sending floating ip statuses: %s', statuses_by_router)
+        try:
+            if self._fip_statuses_batch_supported:
+                try:
+                    self.plugin_rpc.update_floatingip_statuses_batch(
+                        self.context, statuses_by_router)
+                    return True
+                except oslo_messaging.UnsupportedVersion:
+                    self._fip_statuses_batch_supported = False
+                except oslo_messaging.RemoteError as e:
+                    if e.exc_type != 'UnsupportedVersion':
+                        raise
+                    self._fip_statuses_batch_supported = False
+                LOG.warning(_LW('Neutron server does not support batched '
+                                'floating ip status updates, falling back '
+                                'to one update per router.'))
+            for router_id, fip_statuses in six.iteritems(statuses_by_router):
+                self.plugin_rpc.update_floatingip_statuses(
+                    self.context, router_id, fip_statuses)
+                del unsent[router_id]
+            return True
+        except Exception:
+            LOG.exception(_LE("Failed to send floating ip statuses"))
+            self._fip_statuses_not_sent(unsent)
+            self.fullsync = True
+            return False
+
+    def _fip_statuses_not_sent(self, statuses_by_router):
+        # Queue the statuses again under any queued since, a later pass
+        # would not report the DOWN of a floating ip already gone.  What
+        # the server knows is unknown now, so the snapshot is dropped.
+        for router_id, fip_statuses in six.iteritems(statuses_by_router):
+            ri = self.router_info.get(router_id)
+            if not ri:
+                continue
+            pending = dict(fip_statuses)
+            pending.update(self._pending_fip_statuses.get(router_id, {}))
+            self._pending_fip_statuses[router_id] = pending
+            ri.sent_fip_statuses = None
 
     @common_utils.exception_logger()
     def process_router(self, ri):
+        self._router_counts_dirty = True
+        router = ri.router
         # TODO(mrsmith) - we shouldn't need to check here
-        if 'distributed' not in ri.router:
-            ri.router['distributed'] = False
+        router.setdefault('distributed', False)
         ex_gw_port = ri.get_ex_gw_port()
-        if ri.router.get('distributed') and ex_gw_port:
+        if router['distributed'] and ex_gw_port:
             ri.fip_ns = self.get_fip_ns(ex_gw_port['network_id'])
             ri.fip_ns.scan_fip_ports(ri)
         ri._process_internal_ports()
@@ -363,8 +528,21 @@ class L3NATAgent(firewall_l3_agent.FWaaSL3AgentRpcCallback,
 
         # Update ex_gw_port and enable_snat on the router info cache
         ri.ex_gw_port = ex_gw_port
-        ri.snat_ports = ri.router.get(l3_constants.SNAT_ROUTER_INTF_KEY, [])
-        ri.enable_snat = ri.router.get('enable_snat')
+        ri.snat_ports = router.get(SNAT_ROUTER_INTF_KEY, [])
+        ri.enable_snat = router.get('enable_snat')
+
+    @common_utils.exception_logger()
+    def _process_router_teardown(self, ri):
+        """Process a router stripped of its gateway, interfaces and fips.
+
+        Only the steps which undo something are run: internal ports and
+        external processing (needed when namespaces are not deleted, and by
+        DVR to clean up the fip namespace) and port forwarding removal.
+        Static routes, fip namespace scan and keepalived are skipped.
+        """
+        ri._process_internal_ports()
+        ri.process_external(self)
+        self.process_router_portforwardings(ri, None)
 
     def router_deleted(self, context, router_id):
         """Deal with router deletion RPC message."""
@@ -381,9 +559,8 @@ class L3NATAgent(firewall_l3_agent.FWaaSL3AgentRpcCallback,
             # This is needed for backward compatibility
             if isinstance(routers[0], dict):
                 routers = [router['id'] for router in routers]
-            for id in routers:
-                update = queue.RouterUpdate(id, queue.PRIORITY_RPC)
-                self._queue.add(update)
+            self._queue.add_many(
+                queue.RouterUpdate(id, queue.PRIORITY_RPC) for id in routers)
 
     def router_removed_from_agent(self, context, payload):
         LOG.debug('Got router removed from agent :%r', payload)
@@ -420,7 +597,13 @@ class L3NATAgent(firewall_l3_agent.FWaaSL3AgentRpcCallback,
         if (target_ex_net_id and ex_net_id and ex_net_id != target_ex_net_id):
             # Double check that our single external_net_id has not changed
             # by forcing a check by RPC.
+            fetched_at = self._ex_net_id_fetched_at
             if ex_net_id != self._fetch_external_net_id(force=True):
+                if (fetched_at is not None and
+                        fetched_at == self._ex_net_id_fetched_at):
+                    # The check reused a recent answer, which may predate a
+                    # change of the external network
+                    self._recheck_router_later(router['id'])
                 raise n_exc.RouterNotCompatibleWithAgent(
                     router_id=router['id'])
 
@@ -429,6 +612,19 @@ class L3NATAgent(firewall_l3_agent.FWaaSL3AgentRpcCallback,
         else:
             self._process_updated_router(router)
 
+    def _recheck_router_later(self, router_id):
+        """Queue the router again once the external network id expired."""
+        if router_id in self._routers_to_recheck:
+            return
+        self._routers_to_recheck.add(router_id)
+        eventlet.spawn_after(EXTERNAL_NETWORK_ID_TTL,
+                             self._recheck_router, router_id)
+
+    def _recheck_router(self, router_id):
+        self._routers_to_recheck.discard(router_id)
+        self._queue.add(queue.RouterUpdate(router_id,
+                                           queue.PRIORITY_SYNC_ROUTERS_TASK))
+
     def _process_added_router(self, router):
         # TODO(pcm): Next refactoring will rework this logic
         self._router_added(router['id'], router)
@@ -442,30 +638,61 @@ class L3NATAgent(firewall_l3_agent.FWaaSL3AgentRpcCallback,
         # TODO(pcm): Next refactoring will rework this logic
         ri = self.router_info[router['id']]
         ri.router = router
+        self._router_counts_dirty = True
         self.event_observers.notify(
             adv_svc.AdvancedService.before_router_updated, ri)
         self.process_router(ri)
         self.event_observers.notify(
             adv_svc.AdvancedService.after_router_updated, ri)
 
+    def _fetch_router(self, update):
+        """Fetch the router of update from the server.
+
+        Other queued updates still lacking their router data are fetched with
+        the same RPC call and given back to the queue with the data attached,
+        so that a burst of notifications does not cost one call per router.
+        """
+        pending = self._queue.take_updates_to_fetch(
+            self.conf.router_update_coalesce_max - 1)
+        router_ids = [update.id]
+        for pending_update in pending:
+            if pending_update.id not in router_ids:
+                router_ids.append(pending_update.id)
+
+        timestamp = timeutils.utcnow()
+        try:
+            routers = self.plugin_rpc.get_routers(self.context, router_ids)
+        except Exception:
+            for pending_update in pending:
+                self._queue.add(pending_update)
+            raise
+
+        LOG.debug("Fetched %(count)d routers for %(ids)s",
+                  {'count': len(routers), 'ids': router_ids})
+        routers_by_id = dict((r['id'], r) for r in routers)
+        update.timestamp = timestamp
+        for pending_update in pending:
+            pending_update.timestamp = timestamp
+            pending_update.router = routers_by_id.get(pending_update.id)
+            if not pending_update.router:
+                # The router is gone or no longer hosted by this agent
+                pending_update.action = queue.DELETE_ROUTER
+            self._queue.add(pending_update)
+        return routers_by_id.get(update.id)
+
     def _process_router_update(self):
         for rp, update in self._queue.each_update_to_next_router():
             LOG.debug("Starting router update for %s", update.id)
             router = update.router
             if update.action != queue.DELETE_ROUTER and not router:
                 try:
-                    update.timestamp = timeutils.utcnow()
-                    routers = self.plugin_rpc.get_routers(self.context,
-                                                          [update.id])
+                    router = self._fetch_router(update)
                 except Exception:
                     msg = _LE("Failed to fetch router information for '%s'")
                     LOG.exception(msg, update.id)
                     self.fullsync = True
                     continue
 
-                if routers:
-                    router = routers[0]
-
             if not router:
                 try:
                     self._router_removed(update.id)
@@ -494,11 +721,19 @@ class L3NATAgent(firewall_l3_agent.FWaaSL3AgentRpcCallback,
             LOG.debug("Finished a router update for %s", update.id)
             rp.fetched_and_processed(update.timestamp)
 
+        self._send_fip_statuses()
+
     def _process_routers_loop(self):
         LOG.debug("Starting _process_routers_loop")
-        pool = eventlet.GreenPool(size=8)
+        pool = eventlet.GreenPool(size=self.conf.router_processing_pool_size)
         while True:
+            # Only start a worker once there is an update for it, and let it
+            # dequeue the update before looking at the queue again.
+            # spawn_n() blocks while the pool is full, which throttles this
+            # loop to the rate at which workers finish.
+            self._queue.wait_nonempty()
             pool.spawn_n(self._process_router_update)
+            eventlet.sleep(0)
 
     @periodic_task.periodic_task
     def periodic_sync_routers_task(self, context):
@@ -539,26 +774,27 @@ class L3NATAgent(firewall_l3_agent.FWaaSL3AgentRpcCallback,
             raise n_exc.AbortSyncRouters()
         else:
             LOG.debug('Processing :%r', routers)
-            for r in routers:
-                ns_manager.keep_router(r['id'])
-                update = queue.RouterUpdate(r['id'],
-                                            queue.PRIORITY_SYNC_ROUTERS_TASK,
-                                            router=r,
-                                            timestamp=timestamp)
-                self._queue.add(update)
-            self.fullsync = False
-            LOG.debug("periodic_sync_routers_task successfully completed")
-
             curr_router_ids = set([r['id'] for r in routers])
+            # Routers that have disappeared since the last sync are deleted
+            removed_router_ids = prev_router_ids - curr_router_ids
 
-            # Delete routers that have disappeared since the last sync
-            for router_id in prev_router_ids - curr_router_ids:
+            # Namespaces of removed routers are kept for _router_removed
+            for router_id in curr_router_ids | removed_router_ids:
                 ns_manager.keep_router(router_id)
-                update = queue.RouterUpdate(router_id,
-                                            queue.PRIORITY_SYNC_ROUTERS_TASK,
-                                            timestamp=timestamp,
-                                            action=queue.DELETE_ROUTER)
-                self._queue.add(update)
+
+            updates = [queue.RouterUpdate(r['id'],
+                                          queue.PRIORITY_SYNC_ROUTERS_TASK,
+                                          router=r,
+                                          timestamp=timestamp)
+                       for r in routers]
+            updates.extend(queue.RouterUpdate(router_id,
+                                              queue.PRIORITY_SYNC_ROUTERS_TASK,
+                                              timestamp=timestamp,
+                                              action=queue.DELETE_ROUTER)
+                           for router_id in removed_router_ids)
+            self._queue.add_many(updates)
+            self.fullsync = False
+            LOG.debug("periodic_sync_routers_task successfully completed")
 
     def after_start(self):
         eventlet.spawn_n(self._process_routers_loop)
@@ -566,35 +802,38 @@ class L3NATAgent(firewall_l3_agent.FWaaSL3AgentRpcCallback,
         # When L3 agent is ready, we immediately do a full sync
         self.periodic_sync_routers_task(self.context)
 
-    def _update_portforwardings(self, ri, operation, portfwd):
-        """Configure the router's port forwarding rules."""
-        #chain_in, chain_out = "PREROUTING", "snat"
-        chain_in = "PREROUTING"
-        rule_in = ("-p %(protocol)s"
-            " -d %(outside_addr)s --dport %(outside_port)s"
-            " -j DNAT --to %(inside_addr)s:%(inside_port)s"
-            % portfwd)
-        #rule_out = ("-p %(protocol)s"
-        #   " -s %(inside_addr)s --sport %(inside_port)s"
-        #   " -j SNAT --to %(outside_addr)s:%(outside_port)s"
-        #   % portfwd)
-        if operation == 'create':
-            LOG.debug("Added portforwarding rule_in is '%s'" % rule_in)
-            ri.iptables_manager.ipv4['nat'].add_rule(chain_in, rule_in,
-                                                     tag='portforwarding')
-        #note: SNAT rule are not necessary for portforwarding
-        #LOG.debug(_("Added portforwarding rule_out is '%s'"), rule_out)
-        #ri.iptables_manager.ipv4['nat'].add_rule(chain_out, rule_out,
-        #                   top=True,
-        #                   tag='portforwarding')
-        elif operation == 'delete':
-            LOG.debug("Removed portforwarding rule_in is '%s'" % rule_in)
-            ri.iptables_manager.ipv4['nat'].remove_rule(chain_in, rule_in)
-            #note: SNAT rule are not necessary for portforwarding
-            #LOG.debug(_("Removed portforwarding rule_out is '%s'"), rule_out)
-            #ri.iptables_manager.ipv4['nat'].remove_rule(chain_out, rule_out)
-        else:
-            raise Exception('should never be here')
+    def _update_portforwardings_bulk(self, ri, creates, deletes):
+        """Configure the router's port forwarding rules.
+
+        Removed rules are filtered out of the nat table in a single pass
+        instead of one remove_rule() scan per rule, then new rules are added.
+        The rule rendered for a portforwarding is kept in
+        ri.portforwarding_rules until it is deleted, so removal does not
+        render it again.
+        """
+        #note: SNAT rules are not necessary for portforwarding
+        nat = ri.iptables_manager.ipv4['nat']
+        rule_cache = ri.portforwarding_rules
+        if deletes:
+            rules_in = set()
+            for portfwd in deletes:
+                rule_in = rule_cache.pop(portfwd['id'], None)
+                if rule_in is None:
+                    rule_in = _portforwarding_rule(portfwd)
+                rules_in.add(rule_in)
+            LOG.debug("Removed portforwarding rules_in are '%s'", rules_in)
+            nat.rules = [rule for rule in nat.rules
+                         if not (rule.tag == PORTFORWARDING_TAG and
+                                 rule.chain == PORTFORWARDING_CHAIN and
+                                 rule.rule in rules_in)]
+        # An updated portforwarding shows up in both lists under the same id,
+        # so deletes must be handled first to keep the cache right.
+        for portfwd in creates:
+            rule_in = _portforwarding_rule(portfwd)
+            rule_cache[portfwd['id']] = rule_in
+            LOG.debug("Added portforwarding rule_in is '%s'", rule_in)
+            nat.add_rule(PORTFORWARDING_CHAIN, rule_in,
+                         tag=PORTFORWARDING_TAG)
 
     def process_router_portforwardings(self, ri, ex_gw_port):
         if 'portforwardings' not in ri.router:
@@ -604,29 +843,25 @@ class L3NATAgent(firewall_l3_agent.FWaaSL3AgentRpcCallback,
             return None
         if ex_gw_port:
             new_portfwds = ri.router['portforwardings']
+            outside_addr = ex_gw_port['fixed_ips'][0]['ip_address']
             for new_portfwd in new_portfwds:
-                new_portfwd['outside_addr'] = (
-                    ex_gw_port.get('fixed_ips')[0].get('ip_address'))
-                LOG.debug("New Portforwarding: %s" % new_portfwd.values())
+                new_portfwd['outside_addr'] = outside_addr
+            LOG.debug("New Portforwardings: %s", new_portfwds)
             old_portfwds = ri.portforwardings
-            for old_portfwd in old_portfwds:
-                LOG.debug("Old Portforwarding: %s" % old_portfwd.values())
-            adds, removes = common_utils.diff_list_of_dict(old_portfwds,
-                            new_portfwds)
-            for portfwd in adds:
-                LOG.debug("Add Portforwarding: %s" % portfwd.values())
-                self._update_portforwardings(ri, 'create', portfwd)
-            for portfwd in removes:
-                LOG.debug("Del Portforwarding: %s" % portfwd.values())
-                self._update_portforwardings(ri, 'delete', portfwd)
+            LOG.debug("Old Portforwardings: %s", old_portfwds)
+            adds, removes = _diff_portforwardings(old_portfwds, new_portfwds)
+            LOG.debug("Add Portforwardings: %s", adds)
+            LOG.debug("Del Portforwardings: %s", removes)
             ri.portforwardings = new_portfwds
         else:
-            old_portfwds = ri.portforwardings
-            for old_portfwd in old_portfwds:
-                    LOG.debug("Del Portforwarding: %s" % old_portfwd.values())
-                    self._update_portforwardings(ri, 'delete', old_portfwd)
+            adds, removes = [], ri.portforwardings
+            LOG.debug("Del Portforwardings: %s", removes)
             ri.portforwardings = []
 
+        # Nothing to apply, spare the iptables-save/iptables-restore run
+        if not adds and not removes:
+            return
+        self._update_portforwardings_bulk(ri, adds, removes)
         ri.iptables_manager.apply()
 
 
@@ -653,6 +888,7 @@ class L3NATAgentWithStateReport(L3NATAgent):
             'agent_type': l3_constants.AGENT_TYPE_L3}
         report_interval = self.conf.AGENT.report_interval
         self.use_call = True
+        self._report_state_failures = 0
         if report_interval:
             self.heartbeat = loopingcall.FixedIntervalLoopingCall(
                 self._report_state)
@@ -660,29 +896,34 @@ class L3NATAgentWithStateReport(L3NATAgent):
 
     def _report_state(self):
         LOG.debug("Report state task started")
-        num_ex_gw_ports = 0
-        num_interfaces = 0
-        num_floating_ips = 0
-        router_infos = self.router_info.values()
-        num_routers = len(router_infos)
-        for ri in router_infos:
-            ex_gw_port = ri.get_ex_gw_port()
-            if ex_gw_port:
-                num_ex_gw_ports += 1
-            num_interfaces += len(ri.router.get(l3_constants.INTERFACE_KEY,
-                                                []))
-            num_floating_ips += len(ri.router.get(l3_constants.FLOATINGIP_KEY,
-                                                  []))
-        configurations = self.agent_state['configurations']
-        configurations['routers'] = num_routers
-        configurations['ex_gw_ports'] = num_ex_gw_ports
-        configurations['interfaces'] = num_interfaces
-        configurations['floating_ips'] = num_floating_ips
+        if self._router_counts_dirty:
+            # The counts of the previous report are still in configurations
+            # when no router changed since then
+            self._router_counts_dirty = False
+            num_ex_gw_ports = 0
+            num_interfaces = 0
+            num_floating_ips = 0
+            num_routers = len(self.router_info)
+            for ri in six.itervalues(self.router_info):
+                ex_gw_ports, interfaces, floating_ips = ri.get_state_counts()
+                num_ex_gw_ports += ex_gw_ports
+                num_interfaces += interfaces
+                num_floating_ips += floating_ips
+            configurations = self.agent_state['configurations']
+            configurations['routers'] = num_routers
+            configurations['ex_gw_ports'] = num_ex_gw_ports
+            configurations['interfaces'] = num_interfaces
+            configurations['floating_ips'] = num_floating_ips
+        # Each report doubles as the agent heartbeat, the server marks the
+        # agent down when reports stop, so they must not be coalesced.  The
+        # state is kept in self.agent_state, a failed report is simply
+        # retried with the current values (and start_flag) on the next tick.
         try:
             self.state_rpc.report_state(self.context, self.agent_state,
                                         self.use_call)
             self.agent_state.pop('start_flag', None)
             self.use_call = False
+            self._report_state_failures = 0
             LOG.debug("Report state task successfully completed")
         except AttributeError:
             # This means the server does not support report_state
@@ -691,9 +932,24 @@ class L3NATAgentWithStateReport(L3NATAgent):
             self.heartbeat.stop()
             return
         except Exception:
-            LOG.exception(_LE("Failed reporting state!"))
+            # Only log the traceback now and then while the server stays
+            # unreachable, formatting it on every tick is costly
+            if self._report_state_failures % REPORT_STATE_TRACEBACK_EVERY:
+                LOG.warning(_MSG_REPORT_STATE_FAILED_AGAIN,
+                            self._report_state_failures + 1)
+            else:
+                LOG.exception(_MSG_REPORT_STATE_FAILED)
+            self._report_state_failures += 1
 
     def agent_updated(self, context, payload):
-        """Handle the agent_updated notification event."""
-        self.fullsync = True
-        LOG.info(_LI("agent_updated by server side %s!"), payload)
+        """Handle the agent_updated notification event.
+
+        When the payload names the affected routers only those are queued
+        for processing, otherwise a full sync is scheduled.
+        """
+        router_ids = payload.get('routers') if payload else None
+        if router_ids:
+            self.routers_updated(context, router_ids)
+        else:
+            self.fullsync = True
+        LOG.info(_MSG_AGENT_UPDATED, payload)
@@ -43,6 +43,8 @@ class RouterInfo(object):
         self._snat_action = None
         self.internal_ports = []
         self.floating_ips = set()
+        # Floating IP statuses last queued for or reported to the server
+        self.sent_fip_statuses = None
         # Invoke the setter for establishing initial SNAT action
         self.router = router
         self.use_ipv6 = use_ipv6
@@ -58,6 +60,8 @@ class RouterInfo(object):
             namespace=self.ns_name)
         self.routes = []
         self.portforwardings = []
+        # iptables rules rendered for self.portforwardings, keyed by id
+        self.portforwarding_rules = {}
         self.agent_conf = agent_conf
         self.driver = interface_driver
         # radvd is a neutron.agent.linux.ra.DaemonMonitor
@@ -70,6 +74,7 @@ class RouterInfo(object):
     @router.setter
     def router(self, value):
         self._router = value
+        self._state_counts = None
         if not self._router:
             return
         # enable_snat by default if it wasn't specified by plugin
@@ -142,6 +147,20 @@ class RouterInfo(object):
     def get_ex_gw_port(self):
         return self.router.get('gw_port')
 
+    def get_state_counts(self):
+        """Return the counters reported in the agent state for this router.
+
+        The result is a (ex_gw_ports, interfaces, floating_ips) tuple which is
+        cached until the router dict is replaced.
+        """
+        if self._state_counts is None:
+            router = self.router
+            self._state_counts = (
+                1 if self.get_ex_gw_port() else 0,
+                len(router.get(l3_constants.INTERFACE_KEY) or ()),
+                len(router.get(l3_constants.FLOATINGIP_KEY) or ()))
+        return self._state_counts
+
     def get_floating_ips(self):
         """Filter Floating IPs to be hosted on this agent."""
         return self.router.get(l3_constants.FLOATINGIP_KEY, [])
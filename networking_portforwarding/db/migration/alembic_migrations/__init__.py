@@ -0,0 +1,87 @@
+# Copyright 2015 OpenStack Foundation
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""Helpers for data migrations on large tables."""
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def staged_update(source_sql, target, join_keys, set_cols,
+                  stage='migration_stage'):
+    """Update target from the rows returned by source_sql in one statement.
+
+    The rows are first materialized in a temporary stage table indexed on
+    join_keys, then target is updated with a single joined UPDATE instead
+    of running one correlated statement per row.  The stage table is
+    UNLOGGED on PostgreSQL as it is dropped right after use.
+
+    :param source_sql: SELECT returning join_keys and set_cols columns
+    :param target: name of the table to update
+    :param join_keys: columns matching stage rows to target rows
+    :param set_cols: columns of target to set from the stage rows
+    :param stage: name of the stage table, must not exist
+    """
+    dialect = op.get_context().dialect.name
+    unlogged = 'UNLOGGED ' if dialect == 'postgresql' else ''
+    op.execute('CREATE %sTABLE %s AS %s' % (unlogged, stage, source_sql))
+    op.execute('CREATE INDEX ix_%s ON %s (%s)' %
+               (stage, stage, ', '.join(join_keys)))
+
+    join = ' AND '.join('%s.%s = %s.%s' % (target, key, stage, key)
+                        for key in join_keys)
+    if dialect == 'postgresql':
+        sets = ', '.join('%s = %s.%s' % (col, stage, col)
+                         for col in set_cols)
+        op.execute('UPDATE %s SET %s FROM %s WHERE %s' %
+                   (target, sets, stage, join))
+    elif dialect == 'mysql':
+        sets = ', '.join('%s.%s = %s.%s' % (target, col, stage, col)
+                         for col in set_cols)
+        op.execute('UPDATE %s JOIN %s ON %s SET %s' %
+                   (target, stage, join, sets))
+    else:
+        sets = ', '.join('%s = (SELECT %s.%s FROM %s WHERE %s)' %
+                         (col, stage, col, stage, join) for col in set_cols)
+        op.execute('UPDATE %s SET %s WHERE EXISTS (SELECT 1 FROM %s WHERE %s)'
+                   % (target, sets, stage, join))
+
+    op.execute('DROP TABLE %s' % stage)
+
+
+def id_batches(table, batch_size=1000, id_col='id'):
+    """Yield the ids of table in ascending batches of at most batch_size.
+
+    Each batch is read with a keyset query starting after the last id of the
+    previous one, so every query is an index range scan on id rather than an
+    OFFSET re-reading all the rows skipped so far.  A migration can then run
+    "UPDATE ... WHERE id >= :first AND id <= :last" per batch, which bounds
+    the size of each statement.  It does not shorten the locks: neutron
+    runs every revision of an upgrade in one transaction, so the updated
+    rows stay locked until the whole upgrade commits.  The rows are read
+    from the database, so this cannot be used when generating offline SQL.
+    """
+    bind = op.get_bind()
+    first = sa.text('SELECT %(id)s FROM %(table)s ORDER BY %(id)s LIMIT :n' %
+                    {'id': id_col, 'table': table})
+    after = sa.text('SELECT %(id)s FROM %(table)s WHERE %(id)s > :last '
+                    'ORDER BY %(id)s LIMIT :n' %
+                    {'id': id_col, 'table': table})
+    ids = [row[0] for row in bind.execute(first, {'n': batch_size})]
+    while ids:
+        yield ids
+        if len(ids) < batch_size:
+            return
+        ids = [row[0] for row in bind.execute(after, {'last': ids[-1],
+                                                      'n': batch_size})]
@@ -48,6 +48,9 @@ def upgrade(active_plugins=None, options=None):
         sa.ForeignKeyConstraint(['router_id'], ['routers.id'],
                                 ondelete='CASCADE'),
         sa.PrimaryKeyConstraint('id'),
+        # The index backing this constraint leads with router_id, so it also
+        # serves the per-router lookups and the ON DELETE CASCADE from
+        # routers; a separate router_id index would only slow down writes.
         sa.UniqueConstraint('router_id', 'protocol', 'outside_port',
                             name='outside_port')
                     )
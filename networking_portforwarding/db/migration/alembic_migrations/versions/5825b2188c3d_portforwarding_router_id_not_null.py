@@ -0,0 +1,64 @@
+# Copyright 2015 OpenStack Foundation
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+
+"""Make router_id of portforwardingrules not nullable
+
+Revision ID: 5825b2188c3d
+Revises: 38c55b05413c
+Create Date: 2015-04-20 11:02:37.512846
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '5825b2188c3d'
+down_revision = '38c55b05413c'
+
+# Change to ['*'] if this migration applies to all plugins
+
+migration_for_plugins = [
+    'neutron.plugins.ml2.plugin.Ml2Plugin'
+]
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# Longest wait for the table lock before giving up, so a busy neutron server
+# is not stalled behind the migration
+LOCK_TIMEOUT = '5s'
+
+
+def _alter_router_id(nullable):
+    # Every revision of an upgrade runs in the same transaction, the lock
+    # timeout is put back right after the ALTER so that it does not apply
+    # to the migrations coming after this one.
+    postgresql = op.get_context().dialect.name == 'postgresql'
+    if postgresql:
+        op.execute("SET LOCAL lock_timeout = '%s'" % LOCK_TIMEOUT)
+    op.alter_column('portforwardingrules', 'router_id',
+                    existing_type=sa.String(length=36),
+                    nullable=nullable)
+    if postgresql:
+        op.execute("SET LOCAL lock_timeout = DEFAULT")
+
+
+def upgrade(active_plugins=None, options=None):
+    # A rule always belongs to a router, the API requires router_id and the
+    # foreign key cascades on router deletion, so no row can hold a NULL.
+    _alter_router_id(nullable=False)
+
+
+def downgrade(active_plugins=None, options=None):
+    _alter_router_id(nullable=True)
@@ -24,11 +24,11 @@ from neutron.db import model_base
 from neutron.db import models_v2
 from neutron.extensions import l3
 from neutron.extensions import portforwardings
-from neutron.i18n import _LE
 from neutron.i18n import _LI
 from oslo_db import exception as db_exc
 from oslo_log import log as logging
-from oslo_utils import excutils
+from oslo_utils import uuidutils
+import six
 from sqlalchemy import orm
 from sqlalchemy.orm import exc
 
@@ -41,7 +41,8 @@ class PortForwardingRule(model_base.BASEV2, models_v2.HasId,
 
     router_id = sa.Column(sa.String(36),
                           sa.ForeignKey('routers.id',
-                                        ondelete="CASCADE"))
+                                        ondelete="CASCADE"),
+                          nullable=False)
 
     router = orm.relationship(l3_db.Router,
                               backref=orm.backref("portforwarding_list",
@@ -112,31 +113,82 @@ class PortForwardingDbMixin(l3_db.L3_NAT_db_mixin,
             raise portforwardings.PortForwardingRuleNotFound(
                                   port_forwarding_rule_id=id)
 
-    def _create_bulk(self, resource, context, request_items):
-        objects = []
-        collection = "%ss" % resource
-        items = request_items[collection]
-        context.session.begin(subtransactions=True)
-        try:
-            for item in items:
-                obj_creator = getattr(self, 'create_%s' % resource)
-                objects.append(obj_creator(context, item))
-            context.session.commit()
-        except Exception:
-            context.session.rollback()
-            with excutils.save_and_reraise_exception():
-                LOG.error(_LE("An exception occurred while creating "
-                            "the %(resource)s:%(item)s"),
-                          {'resource': resource, 'item': item})
-        return objects
+    @staticmethod
+    def _outside_port(portfwd):
+        return '%s %s' % (portfwd['protocol'], portfwd['outside_port'])
+
+    @classmethod
+    def _outside_port_key(cls, portfwd):
+        # The unique constraint holds NULLs as distinct, so a rule lacking
+        # its protocol or outside port never conflicts
+        if portfwd['protocol'] is None or portfwd['outside_port'] is None:
+            return None
+        return portfwd['router_id'], cls._outside_port(portfwd)
 
     def create_portforwarding_bulk(self, context, portforwarding):
-        return self._create_bulk('portforwarding', context,
-                                 portforwarding)
+        """Create many port forwarding rules in a single flush.
+
+        Each router is looked up, validated and notified once for all of its
+        rules instead of once per rule.
+        """
+        ports = [item['portforwarding']
+                 for item in portforwarding['portforwardings']]
+        ports_by_router = {}
+        for port in ports:
+            ports_by_router.setdefault(port['router_id'], []).append(port)
+
+        with context.session.begin(subtransactions=True):
+            used = set()
+            for router_id, router_ports in six.iteritems(ports_by_router):
+                router = self._get_router(context, router_id)
+                self._validate_fwds(context, router, router_ports)
+                used.update(self._outside_port_key(rule)
+                            for rule in router['portforwarding_list'])
+            used.discard(None)
+
+            # A failed flush does not tell which rule is duplicated, look
+            # for it first so it is reported like create_portforwarding does
+            for port in ports:
+                key = self._outside_port_key(port)
+                if key is None:
+                    continue
+                if key in used:
+                    raise portforwardings.DuplicatedOutsidePort(
+                        port=self._outside_port(port))
+                used.add(key)
+
+            # With the ids set here rather than by the column default, the
+            # flush knows every primary key and inserts all the rows with a
+            # single executemany
+            rules = [PortForwardingRule(id=uuidutils.generate_uuid(),
+                                        tenant_id=port['tenant_id'],
+                                        router_id=port['router_id'],
+                                        outside_port=port['outside_port'],
+                                        inside_addr=port['inside_addr'],
+                                        inside_port=port['inside_port'],
+                                        protocol=port['protocol'])
+                     for port in ports]
+            context.session.add_all(rules)
+            try:
+                context.session.flush()
+            except db_exc.DBDuplicateEntry as e:
+                LOG.info(_LI('Exception: %s'), e.inner_exception.message)
+                if 'outside_port' in e.columns:
+                    # Rules created concurrently, name all those requested
+                    raise portforwardings.DuplicatedOutsidePort(
+                        port=', '.join(self._outside_port(port)
+                                       for port in ports))
+                raise
+
+            for router_id in ports_by_router:
+                self.notify_router_updated(context, router_id)
+
+            return [self._make_portforwarding_rule_dict(rule)
+                    for rule in rules]
 
     def create_portforwarding(self, context, portforwarding):
         with context.session.begin(subtransactions=True):
-            LOG.debug('create_portforwarding ->  portforwarding: %s' %
+            LOG.debug('create_portforwarding ->  portforwarding: %s',
                       portforwarding)
 
             port = portforwarding['portforwarding']
@@ -153,7 +205,7 @@ class PortForwardingDbMixin(l3_db.L3_NAT_db_mixin,
                             protocol=port['protocol'])
                     context.session.add(rule)
                     context.session.flush()
-                    LOG.debug('router type: %s' % router)
+                    LOG.debug('router type: %s', router)
                     self.notify_router_updated(context, router['id'])
 
                     return self._make_portforwarding_rule_dict(rule)
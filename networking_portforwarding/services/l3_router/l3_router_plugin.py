@@ -14,7 +14,9 @@
 #    under the License.
 
 from oslo_config import cfg
+import oslo_messaging
 from oslo_utils import importutils
+import six
 
 from neutron.api.rpc.agentnotifiers import l3_rpc_agent_api
 from neutron.api.rpc.handlers import l3_rpc
@@ -32,6 +34,25 @@ from neutron.db import portforwardings_db
 from neutron.plugins.common import constants
 
 
+class L3RpcCallback(l3_rpc.L3RpcCallback):
+    """L3 agent RPC callback in plugin implementations.
+
+    API version history:
+        1.6 - Added update_floatingip_statuses_batch
+    """
+    target = oslo_messaging.Target(version='1.6')
+
+    def update_floatingip_statuses_batch(self, context, host,
+                                         statuses_by_router):
+        """Update operational status for the floating IPs of many routers.
+
+        :param statuses_by_router: a dict of fip_statuses dicts keyed by
+                                   router id
+        """
+        for router_id, fip_statuses in six.iteritems(statuses_by_router):
+            self.update_floatingip_statuses(context, router_id, fip_statuses)
+
+
 class L3RouterPlugin(common_db_mixin.CommonDbMixin,
                      extraroute_db.ExtraRoute_db_mixin,
                      l3_hamode_db.L3_HA_NAT_db_mixin,
@@ -69,7 +90,7 @@ class L3RouterPlugin(common_db_mixin.CommonDbMixin,
         self.conn = n_rpc.create_connection(new=True)
         self.agent_notifiers.update(
             {q_const.AGENT_TYPE_L3: l3_rpc_agent_api.L3AgentNotifyAPI()})
-        self.endpoints = [l3_rpc.L3RpcCallback()]
+        self.endpoints = [L3RpcCallback()]
         self.conn.create_consumer(self.topic, self.endpoints,
                                   fanout=False)
         self.conn.consume_in_threads()
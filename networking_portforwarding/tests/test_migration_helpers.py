@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""
+test_migration_helpers
+----------------------------------
+
+Tests for the data migration helpers of
+`networking_portforwarding.db.migration.alembic_migrations`, run on SQLite.
+"""
+
+from alembic import migration
+from alembic import operations
+import sqlalchemy as sa
+
+from networking_portforwarding.db.migration import alembic_migrations
+from networking_portforwarding.tests import base
+
+
+class TestMigrationHelpers(base.TestCase):
+
+    def setUp(self):
+        super(TestMigrationHelpers, self).setUp()
+        self.engine = sa.create_engine('sqlite://')
+        self.addCleanup(self.engine.dispose)
+        self.metadata = sa.MetaData()
+        self.rules = sa.Table('rules', self.metadata,
+                              sa.Column('id', sa.String(36),
+                                        primary_key=True),
+                              sa.Column('protocol', sa.String(4)))
+        self.metadata.create_all(self.engine)
+
+    def _add_rules(self, count):
+        with self.engine.begin() as conn:
+            conn.execute(self.rules.insert(),
+                         [{'id': 'rule-%02d' % i, 'protocol': 'TCP'}
+                          for i in range(count)])
+
+    def _run(self, func, *args, **kwargs):
+        with self.engine.begin() as conn:
+            context = migration.MigrationContext.configure(conn)
+            with operations.Operations.context(context):
+                return func(*args, **kwargs)
+
+    def _id_batches(self, batch_size):
+        return self._run(lambda: list(alembic_migrations.id_batches(
+            'rules', batch_size=batch_size)))
+
+    def _protocols(self):
+        with self.engine.connect() as conn:
+            rows = conn.execute(sa.text('SELECT id, protocol FROM rules'))
+            return dict((row[0], row[1]) for row in rows)
+
+    def test_id_batches(self):
+        self._add_rules(7)
+        self.assertEqual([['rule-00', 'rule-01', 'rule-02'],
+                          ['rule-03', 'rule-04', 'rule-05'],
+                          ['rule-06']],
+                         self._id_batches(3))
+
+    def test_id_batches_full_last_batch(self):
+        self._add_rules(6)
+        self.assertEqual([['rule-00', 'rule-01', 'rule-02'],
+                          ['rule-03', 'rule-04', 'rule-05']],
+                         self._id_batches(3))
+
+    def test_id_batches_empty(self):
+        self.assertEqual([], self._id_batches(3))
+
+    def test_staged_update(self):
+        self._add_rules(3)
+        self._run(alembic_migrations.staged_update,
+                  "SELECT id, lower(protocol) AS protocol FROM rules "
+                  "WHERE id != 'rule-01'",
+                  'rules', ['id'], ['protocol'])
+        self.assertEqual({'rule-00': 'tcp',
+                          'rule-01': 'TCP',
+                          'rule-02': 'tcp'},
+                         self._protocols())
+        # The stage table is dropped once used
+        self.assertEqual(['rules'], sa.inspect(self.engine).get_table_names())
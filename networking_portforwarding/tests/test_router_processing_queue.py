@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""
+test_router_processing_queue
+----------------------------------
+
+Tests for `networking_portforwarding.agent.l3.router_processing_queue`,
+run under eventlet monkey patching like the agent.
+"""
+
+import datetime
+
+import eventlet
+
+from networking_portforwarding.agent.l3 import router_processing_queue as rpq
+from networking_portforwarding.tests import base
+
+_uuid = ['router-%d' % i for i in range(10)]
+
+
+class TestRouterProcessingQueue(base.TestCase):
+
+    def setUp(self):
+        super(TestRouterProcessingQueue, self).setUp()
+        self.queue = rpq.RouterProcessingQueue()
+        self.timestamp = datetime.datetime(2015, 4, 20)
+        # Processed timestamps are kept per router id across instances
+        self.addCleanup(rpq.ExclusiveRouterProcessor._router_timestamps.clear)
+
+    def _update(self, router_id, priority=rpq.PRIORITY_RPC, **kwargs):
+        return rpq.RouterUpdate(router_id, priority,
+                                timestamp=self.timestamp, **kwargs)
+
+    def _add_all(self, updates):
+        for update in updates:
+            self.queue.add(update)
+
+    def _next_router_ids(self):
+        return [update.id for rp, update in
+                self.queue.each_update_to_next_router()]
+
+    def test_add_many(self):
+        self.queue.add_many(self._update(router_id)
+                            for router_id in _uuid[:3])
+        self.assertEqual([_uuid[0]], self._next_router_ids())
+        self.assertEqual([_uuid[1]], self._next_router_ids())
+        self.assertEqual([_uuid[2]], self._next_router_ids())
+
+    def test_add_many_priority(self):
+        self.queue.add_many([
+            self._update(_uuid[0], rpq.PRIORITY_SYNC_ROUTERS_TASK),
+            self._update(_uuid[1])])
+        self.assertEqual([_uuid[1]], self._next_router_ids())
+        self.assertEqual([_uuid[0]], self._next_router_ids())
+
+    def test_add_many_empty(self):
+        self.queue.add_many([])
+        self.queue.add(self._update(_uuid[0]))
+        self.assertEqual([_uuid[0]], self._next_router_ids())
+
+    def test_wait_nonempty_returns_when_queued(self):
+        self.queue.add(self._update(_uuid[0]))
+        with eventlet.Timeout(1):
+            self.queue.wait_nonempty()
+
+    def test_wait_nonempty_blocks_until_added(self):
+        waiter = eventlet.spawn(self.queue.wait_nonempty)
+        eventlet.sleep(0)
+        self.assertFalse(waiter.dead)
+        self.queue.add(self._update(_uuid[0]))
+        with eventlet.Timeout(1):
+            waiter.wait()
+
+    def test_process_routers_loop(self):
+        # Same structure as L3NATAgent._process_routers_loop
+        processed = []
+
+        def process_router_update():
+            for rp, update in self.queue.each_update_to_next_router():
+                processed.append(update.id)
+                rp.fetched_and_processed(update.timestamp)
+
+        def process_routers_loop():
+            pool = eventlet.GreenPool(size=4)
+            while True:
+                self.queue.wait_nonempty()
+                pool.spawn_n(process_router_update)
+                eventlet.sleep(0)
+
+        loop = eventlet.spawn(process_routers_loop)
+        self.addCleanup(loop.kill)
+        self.queue.add_many(self._update(router_id)
+                            for router_id in _uuid[:6])
+        self.queue.add(self._update(_uuid[6]))
+        with eventlet.Timeout(1):
+            while len(processed) < 7:
+                eventlet.sleep(0.01)
+        self.assertEqual(sorted(_uuid[:7]), sorted(processed))
+        self.assertFalse(loop.dead)
+
+    def test_take_updates_to_fetch(self):
+        self._add_all([
+            self._update(_uuid[0], rpq.PRIORITY_SYNC_ROUTERS_TASK),
+            self._update(_uuid[1], router={'id': _uuid[1]}),
+            self._update(_uuid[2], action=rpq.DELETE_ROUTER),
+            self._update(_uuid[3])])
+        taken = self.queue.take_updates_to_fetch(5)
+        self.assertEqual([_uuid[3], _uuid[0]],
+                         [update.id for update in taken])
+        # Updates carrying their router or deleting it are left queued
+        self.assertEqual([_uuid[1]], self._next_router_ids())
+        self.assertEqual([_uuid[2]], self._next_router_ids())
+
+    def test_take_updates_to_fetch_limit(self):
+        self._add_all(self._update(router_id) for router_id in _uuid[:3])
+        self.assertEqual([], self.queue.take_updates_to_fetch(0))
+        taken = self.queue.take_updates_to_fetch(2)
+        self.assertEqual(_uuid[:2], [update.id for update in taken])
+        self.assertEqual([_uuid[2]], self._next_router_ids())
+
+    def test_take_updates_to_fetch_then_wait(self):
+        self._add_all(self._update(router_id) for router_id in _uuid[:2])
+        self.queue.take_updates_to_fetch(2)
+        # The releases of the taken updates must not let a worker dequeue
+        # from an empty heap
+        worker = eventlet.spawn(self._next_router_ids)
+        eventlet.sleep(0)
+        self.assertFalse(worker.dead)
+        self.queue.add(self._update(_uuid[2]))
+        with eventlet.Timeout(1):
+            self.assertEqual([_uuid[2]], worker.wait())